@@ -1,13 +1,16 @@
 import os
 import pickle
+import tempfile
 import boto3
 import botocore
 
 import pyarrow
 import pyarrow.fs
 import pyarrow.csv
+import pyarrow.compute
 
 import sklearn
+import sklearn.preprocessing
 import numpy as np
 
 import tensorflow as tf
@@ -21,13 +24,18 @@ from ray import train
 from ray.train import RunConfig, ScalingConfig
 from ray.train.tensorflow import TensorflowTrainer
 from ray.train.tensorflow.keras import ReportCheckpointCallback
-from ray.data.preprocessors import Concatenator, StandardScaler
 
 use_gpu = os.environ.get("USE_GPU", "False").lower() == "true"
 num_workers = int(os.environ.get("NUM_WORKERS", "1"))
+# When unset, Ray reserves its default of one CPU per worker and TensorFlow
+# keeps its own thread pool sizing.
+cpus_per_worker = int(os.environ["CPUS_PER_WORKER"]) if "CPUS_PER_WORKER" in os.environ else None
 num_epochs = int(os.environ.get("NUM_EPOCHS", "2"))
-batch_size = int(os.environ.get("BATCH_SIZE", "64"))
-learning_rate = 1e-3
+batch_size = int(os.environ.get("BATCH_SIZE", "512"))
+steps_per_execution = int(os.environ.get("STEPS_PER_EXECUTION", "8"))
+bytes_per_pack = int(os.environ.get("BYTES_PER_PACK", "0"))
+base_batch_size = 64
+base_learning_rate = 1e-3
 output_column_name = "features"
 
 feature_columns = [
@@ -54,6 +62,18 @@ model_output_prefix = os.environ.get("MODEL_OUTPUT", "models/fraud/1/")
 model_output_filename = os.environ.get("MODEL_OUTPUT_FILENAME", "model.onnx")
 scaler_output = model_output_prefix + "scaler.pkl"
 model_output = model_output_prefix + model_output_filename
+model_precision = os.environ.get("MODEL_PRECISION", "fp32").lower()
+if model_precision not in ("fp32", "int8"):
+    raise ValueError(f"Unsupported MODEL_PRECISION {model_precision!r}, expected 'fp32' or 'int8'")
+csv_block_size = int(os.environ.get("CSV_BLOCK_SIZE", str(8 << 20)))
+s3_buffer_size = int(os.environ.get("S3_BUFFER_SIZE", str(16 << 20)))
+
+# jemalloc fragments less than the system allocator under many concurrent
+# Arrow allocations, but it is only available in some pyarrow builds.
+try:
+    pyarrow.set_memory_pool(pyarrow.jemalloc_memory_pool())
+except NotImplementedError:
+    pass
 
 
 def get_pyarrow_fs():
@@ -77,22 +97,75 @@ def get_s3_resource():
 
     return s3_resource
 
-def get_class_weights(pyarrow_fs):
-    with pyarrow_fs.open_input_file(f"{bucket_name}/{train_data}") as file:
-        training_table = pyarrow.csv.read_csv(file)
-
-    y_train = training_table.to_pandas()
-    y_train = y_train.loc[:, label_columns]
+def read_training_table(pyarrow_fs):
+    columns = feature_columns + label_columns
+    convert_options = pyarrow.csv.ConvertOptions(
+        include_columns=columns,
+        column_types={column: pyarrow.float32() for column in columns})
+    read_options = pyarrow.csv.ReadOptions(block_size=csv_block_size, use_threads=True)
+    # The CSV is scanned front to back, so a buffered sequential stream turns
+    # many small ranged GETs into a few large reads.
+    with pyarrow_fs.open_input_stream(f"{bucket_name}/{train_data}", buffer_size=s3_buffer_size) as file:
+        return pyarrow.csv.read_csv(
+            file,
+            read_options=read_options,
+            convert_options=convert_options)
+
+
+def split_table(table, num_blocks):
+    # Table.slice is zero-copy, so this only creates views over the same buffers.
+    rows_per_block = -(-table.num_rows // num_blocks)
+    return [table.slice(offset, rows_per_block) for offset in range(0, table.num_rows, rows_per_block)]
+
+
+def get_steps_per_epoch(num_rows):
+    # get_dataset_shard splits the rows evenly across workers and drops the
+    # remainder; to_tf then yields a final partial batch.
+    rows_per_worker = num_rows // num_workers
+    return -(-rows_per_worker // batch_size)
+
+
+def get_class_weights(training_table):
+    labels = training_table.column(label_columns[0])
+    num_samples = len(labels)
+    num_fraud = pyarrow.compute.sum(labels).as_py()
+    class_counts = {i : count for i, count in enumerate([num_samples - num_fraud, num_fraud]) if count}
     # Since the dataset is unbalanced (it has many more non-fraud transactions than fraudulent ones), set a class weight to weight the few fraudulent transactions higher than the many non-fraud transactions.
-    class_weights = sklearn.utils.class_weight.compute_class_weight(
-        'balanced',
-        classes=np.unique(y_train),
-        y=y_train.values.ravel())
-    class_weights = {i : class_weights[i] for i in range(len(class_weights))}
+    # These are the same "balanced" weights sklearn computes for the classes present: n_samples / (n_classes * count).
+    class_weights = {i : num_samples / (len(class_counts) * count) for i, count in class_counts.items()}
 
     return class_weights
 
 
+def get_scaler_stats(training_table):
+    stats = {}
+    for column in feature_columns:
+        values = training_table.column(column)
+        stats[f"mean({column})"] = pyarrow.compute.mean(values).as_py()
+        stats[f"std({column})"] = pyarrow.compute.stddev(values, ddof=0).as_py()
+
+    return stats
+
+
+def scale_and_concatenate(batch, stats):
+    # Standardize and stack the feature columns in a single pass over each batch.
+    features = []
+    for column in feature_columns:
+        std = stats[f"std({column})"] or 1
+        features.append((batch[column] - stats[f"mean({column})"]) / std)
+
+    scaled_batch = {column: batch[column] for column in label_columns}
+    scaled_batch[output_column_name] = np.column_stack(features).astype(np.float32)
+    return scaled_batch
+
+
+def scale_learning_rate(batch_size):
+    # The model was originally trained with Adam's default 1e-3 at batches of 64;
+    # scale by the square root of the batch size ratio so larger batches keep
+    # model quality.
+    return base_learning_rate * (batch_size / base_batch_size) ** 0.5
+
+
 def build_model() -> tf.keras.Model:
     model = Sequential()
     model.add(Dense(32, activation='relu', input_dim=len(feature_columns)))
@@ -110,47 +183,76 @@ def build_model() -> tf.keras.Model:
 
 
 def train_func(config: dict):
-    batch_size = config.get("batch_size", 64)
+    batch_size = config.get("batch_size", 512)
+    lr = config.get("lr", scale_learning_rate(batch_size))
     epochs = config.get("epochs", 3)
     cw = config.get("class_weight", 3)
-
-    strategy = tf.distribute.MultiWorkerMirroredStrategy()
+    num_threads = config.get("cpus_per_worker")
+    steps_per_execution = config.get("steps_per_execution", 8)
+    steps_per_epoch = config.get("steps_per_epoch")
+    bytes_per_pack = config.get("bytes_per_pack", 0)
+
+    # Keras can only run several steps per execution over a dataset of known size.
+    if steps_per_epoch is None:
+        steps_per_execution = 1
+
+    # Size TensorFlow's thread pools to the CPUs Ray reserved for this worker
+    # so several workers on one node don't oversubscribe it.
+    if num_threads:
+        tf.config.threading.set_intra_op_parallelism_threads(num_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(min(2, num_threads))
+
+    # Pin the collective implementation to ring all-reduce rather than leaving
+    # it to AUTO; NCCL only applies to GPUs, so RING is the choice on CPU workers.
+    # A non-zero bytes_per_pack splits gradients into packs that are all-reduced
+    # as they become ready, overlapping communication with the backward pass.
+    communication_options = tf.distribute.experimental.CommunicationOptions(
+        bytes_per_pack=bytes_per_pack,
+        implementation=tf.distribute.experimental.CommunicationImplementation.RING)
+    strategy = tf.distribute.MultiWorkerMirroredStrategy(
+        communication_options=communication_options)
     with strategy.scope():
         multi_worker_model = build_model()
         multi_worker_model.compile(
-            optimizer="adam",
+            optimizer=tf.keras.optimizers.Adam(learning_rate=lr),
             loss="binary_crossentropy",
             metrics=["accuracy"],
+            # Run several steps inside each tf.function call; the model is tiny,
+            # so per-step Python dispatch would otherwise dominate.
+            steps_per_execution=steps_per_execution,
         )
 
     dataset = train.get_dataset_shard("train")
-    results = []
-
-    for epoch in range(epochs):
-        print(f"Epoch: {epoch}")
-        tf_dataset = dataset.to_tf(
-            feature_columns=output_column_name,
-            label_columns=label_columns[0],
-            batch_size=batch_size
-        )
-        history = multi_worker_model.fit(
-            tf_dataset,
-            class_weight=cw,
-            callbacks=[ReportCheckpointCallback()]
-        )
-        results.append(history.history)
-
-    return results
-
-
-def create_sklearn_standard_scaler(scaler):
+    tf_dataset = dataset.to_tf(
+        feature_columns=output_column_name,
+        label_columns=label_columns[0],
+        batch_size=batch_size
+    )
+    # to_tf() builds the dataset from a generator, so its size is unknown
+    # until we assert the number of batches computed on the driver.
+    if steps_per_epoch is not None:
+        tf_dataset = tf_dataset.apply(tf.data.experimental.assert_cardinality(steps_per_epoch))
+    # The five-feature shard is small enough to keep in memory after the first
+    # epoch, and prefetching overlaps input with each training step.
+    tf_dataset = tf_dataset.cache().prefetch(tf.data.AUTOTUNE)
+    history = multi_worker_model.fit(
+        tf_dataset,
+        epochs=epochs,
+        class_weight=cw,
+        callbacks=[ReportCheckpointCallback()]
+    )
+
+    return history.history
+
+
+def create_sklearn_standard_scaler(stats):
     sk_scaler = sklearn.preprocessing.StandardScaler()
     mean = []
     std = []
 
     for column in feature_columns:
-        mean.append(scaler.stats_[f"mean({column})"])
-        std.append(scaler.stats_[f"std({column})"])
+        mean.append(stats[f"mean({column})"])
+        std.append(stats[f"std({column})"])
 
     sk_scaler.mean_ = np.array(mean)
     sk_scaler.scale_ = np.array(std)
@@ -159,53 +261,64 @@ def create_sklearn_standard_scaler(scaler):
     return sk_scaler
 
 
-def save_scalar(scaler):
-    s3_resource = get_s3_resource()
-    bucket = s3_resource.Bucket(bucket_name)
-    sklearn_scaler = create_sklearn_standard_scaler(scaler)
+def save_scalar(bucket, stats):
+    sklearn_scaler = create_sklearn_standard_scaler(stats)
+
+    print(f"Uploading scaler to {scaler_output}")
+    bucket.put_object(Key=scaler_output, Body=pickle.dumps(sklearn_scaler))
 
-    sk_scaler_filename = "/tmp/scaler.pkl"
-    with open(sk_scaler_filename, "wb") as f:
-        pickle.dump(sklearn_scaler, f)
 
-    print(f"Uploading scaler from {sk_scaler_filename} to {scaler_output}")
-    bucket.upload_file(sk_scaler_filename, scaler_output)
+def convert_model_precision(onnx_model):
+    if model_precision == "int8":
+        # Only int8 exports need onnxruntime, so fp32 jobs don't depend on it.
+        from onnxruntime.quantization import quantize_dynamic, QuantType
 
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            quantized_model_local = os.path.join(tmp_dir, "model.quant.onnx")
+            quantize_dynamic(onnx_model, quantized_model_local, weight_type=QuantType.QInt8)
+            return onnx.load(quantized_model_local)
 
-def save_onnx_model(checkpoint_path):
-    s3_resource = get_s3_resource()
-    bucket = s3_resource.Bucket(bucket_name)
+    return onnx_model
 
+
+def save_onnx_model(bucket, checkpoint_path):
     cp_s3_key = checkpoint_path.removeprefix(f"{bucket_name}/") + "/" + keras_model_filename
     keras_model_local = f"/tmp/{keras_model_filename}"
 
+    # Keras can only load a .keras archive from a path, so the checkpoint still
+    # goes through /tmp. The converted ONNX model is uploaded from memory.
     print(f"Downloading model state_dict from {cp_s3_key} to {keras_model_local}")
     bucket.download_file(cp_s3_key, keras_model_local)
     keras_model = tf.keras.models.load_model(keras_model_local)
-    onnx_model_local = f"/tmp/model.onnx"
     onnx_model, _ = tf2onnx.convert.from_keras(keras_model)
-    onnx.save(onnx_model, onnx_model_local)
+    onnx_model = convert_model_precision(onnx_model)
 
-    print(f"Uploading model from {onnx_model_local} to {model_output}")
-    bucket.upload_file(onnx_model_local, model_output)
+    print(f"Uploading model to {model_output}")
+    bucket.put_object(Key=model_output, Body=onnx_model.SerializeToString())
 
 
 pyarrow_fs = get_pyarrow_fs()
-class_weights = get_class_weights(pyarrow_fs)
+# Read the training data once on the driver and derive everything from that table.
+training_table = read_training_table(pyarrow_fs)
+class_weights = get_class_weights(training_table)
+scaler_stats = get_scaler_stats(training_table)
+
+learning_rate = float(os.environ.get("LEARNING_RATE", scale_learning_rate(batch_size)))
 
-config = {"lr": learning_rate, "batch_size": batch_size, "epochs": num_epochs, "class_weight":class_weights}
+config = {"lr": learning_rate, "batch_size": batch_size, "epochs": num_epochs, "class_weight":class_weights, "cpus_per_worker": cpus_per_worker, "steps_per_execution": steps_per_execution, "steps_per_epoch": get_steps_per_epoch(training_table.num_rows), "bytes_per_pack": bytes_per_pack}
 
-train_dataset = ray.data.read_csv(
-    filesystem=pyarrow_fs,
-    paths=f"s3://{bucket_name}/{train_data}")
-scaler = StandardScaler(columns=feature_columns)
-concatenator = Concatenator(include=feature_columns, output_column_name=output_column_name)
-train_dataset = scaler.fit_transform(train_dataset)
-train_dataset = concatenator.fit_transform(train_dataset)
+train_dataset = ray.data.from_arrow(split_table(training_table, num_workers))
+train_dataset = train_dataset.map_batches(
+    scale_and_concatenate,
+    batch_format="numpy",
+    fn_kwargs={"stats": scaler_stats})
 
-print(scaler.stats_)
+print(scaler_stats)
 
-scaling_config = ScalingConfig(num_workers=num_workers, use_gpu=use_gpu)
+scaling_config = ScalingConfig(
+    num_workers=num_workers,
+    use_gpu=use_gpu,
+    resources_per_worker={"CPU": cpus_per_worker} if cpus_per_worker else None)
 
 trainer = TensorflowTrainer(
     train_loop_per_worker=train_func,
@@ -217,12 +330,13 @@ trainer = TensorflowTrainer(
     ),
     scaling_config=scaling_config,
     datasets={"train": train_dataset},
-    metadata={"preprocessor_pkl": scaler.serialize()},
+    metadata={"scaler_stats": scaler_stats},
 )
 result = trainer.fit()
 metadata = result.checkpoint.get_metadata()
 print(metadata)
-print(StandardScaler.deserialize(metadata["preprocessor_pkl"]))
+print(metadata["scaler_stats"])
 
-save_scalar(scaler)
-save_onnx_model(result.checkpoint.path)
+bucket = get_s3_resource().Bucket(bucket_name)
+save_scalar(bucket, scaler_stats)
+save_onnx_model(bucket, result.checkpoint.path)